@@ -3,11 +3,10 @@ import csv
 import math
 import json
 import os
-import random
+import numpy as np
 import torch
 from pathlib import Path
 from torch.utils.data import Dataset, DataLoader, random_split
-from torch.nn.utils.rnn import pad_sequence
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.optim import Optimizer, AdamW
@@ -47,6 +46,8 @@ The architecture of data directory
     |---- testdata.json
     |---- mapping.json
     |---- uttr-{random string}.pt
+    |---- mels.bin      (generated by pack_mels)
+    |---- mels.npz      (generated by pack_mels)
 The information in metadata
     "n_mels": The dimention of mel-spectrogram.
     "speakers": A dictionary.
@@ -56,8 +57,47 @@ For efficiency, we segment the mel-spectrograms into segments in the traing step
 '''
 
 
+# Number of frames of every training/validation segment.
+SEGMENT_LEN = 128
+
+
+def pack_mels(data_dir, feature_paths, n_mels=40):
+    """
+    Pack the mel-spectrograms into one contiguous fp16 file, so the dataset can memory-map it.
+    Return the path of the packed file and the (first frame, number of frames) of every utterance in it.
+    """
+    blob_path = Path(data_dir) / "mels.bin"
+    index_path = Path(data_dir) / "mels.npz"
+    # Reuse the packed file only if it was packed from exactly the same utterances, in the same order.
+    if blob_path.is_file() and index_path.is_file():
+        with np.load(index_path) as index:
+            if index["feature_paths"].tolist() == list(feature_paths):
+                return blob_path, index["offsets"]
+        print(f"{Bcolors.WARNING}[Info]: {blob_path} does not match the metadata, packing again.{Bcolors.ENDC}")
+
+    # Write to temporary files and rename them at the end, so a half-finished pack is never picked up.
+    tmp_blob_path = blob_path.with_suffix(".bin.tmp")
+    tmp_index_path = index_path.with_suffix(".npz.tmp")
+    offsets = np.zeros((len(feature_paths), 2), dtype=np.int64)
+    start = 0
+    with tmp_blob_path.open("wb") as f:
+        for i, feat_path in enumerate(feature_paths):
+            mel = torch.load(os.path.join(data_dir, feat_path)).numpy().astype(np.float16)
+            f.write(mel.reshape(-1, n_mels).tobytes())
+            offsets[i] = (start, len(mel))
+            start += len(mel)
+            print(f"\r[ Pack | {i + 1}/{len(feature_paths)} ]", flush=True, end=' ')
+    print()
+    with tmp_index_path.open("wb") as f:
+        np.savez(f, feature_paths=np.asarray(feature_paths, dtype=str), offsets=offsets)
+    os.replace(tmp_blob_path, blob_path)
+    os.replace(tmp_index_path, index_path)
+
+    return blob_path, offsets
+
+
 class myDataset(Dataset):
-    def __init__(self, data_dir, segment_len=128):
+    def __init__(self, data_dir, segment_len=SEGMENT_LEN):
         self.data_dir = data_dir
         self.segment_len = segment_len
 
@@ -68,34 +108,47 @@ class myDataset(Dataset):
 
         # Load metadata of training data.
         metadata_path = Path(data_dir) / "metadata.json"
-        metadata = json.load(open(metadata_path))["speakers"]
+        metadata = json.load(open(metadata_path))
+        self.n_mels = metadata["n_mels"]
+        metadata = metadata["speakers"]
 
         # Get the total number of speaker.
         self.speaker_num = len(metadata.keys())
-        self.data = []
+        # Keep the feature paths and the speaker ids in two parallel arrays.
+        self.feature_paths = []
+        labels = []
         for speaker in metadata.keys():
             for utterances in metadata[speaker]:
-                self.data.append([utterances["feature_path"], self.speaker2id[speaker]])
+                self.feature_paths.append(utterances["feature_path"])
+                labels.append(self.speaker2id[speaker])
+        self.labels = np.asarray(labels, dtype=np.int64)
+
+        # Pack all features into one file once, then read them through a memory map.
+        self.blob_path, self.offsets = pack_mels(data_dir, self.feature_paths, self.n_mels)
+        assert len(self.offsets) == len(self.feature_paths)
+        # Opened lazily, so that every dataloader worker maps the file by itself instead of pickling it.
+        self.mels = None
 
     def __len__(self):
-        return len(self.data)
+        return len(self.feature_paths)
 
     def __getitem__(self, index):
-        feat_path, speaker = self.data[index]
-        # Load preprocessed mel-spectrogram.
-        mel = torch.load(os.path.join(self.data_dir, feat_path))
+        if self.mels is None:
+            self.mels = np.memmap(self.blob_path, dtype=np.float16, mode="r").reshape(-1, self.n_mels)
+        start, length = self.offsets[index]
+        # A view into the memory map, no data is read yet.
+        mel = self.mels[start:start + length]
 
         # Segmemt mel-spectrogram into "segment_len" frames.
         if len(mel) > self.segment_len:
             # Randomly get the starting point of the segment.
-            start = random.randint(0, len(mel) - self.segment_len)
+            # torch's generator is seeded differently in every dataloader worker.
+            start = int(torch.randint(0, len(mel) - self.segment_len + 1, (1,)))
             # Get a segment with "segment_len" frames.
-            mel = torch.FloatTensor(mel[start:start + self.segment_len])
-        else:
-            mel = torch.FloatTensor(mel)
-        # Turn the speaker id into long for computing loss later.
-        speaker = torch.FloatTensor([speaker]).long()
-        return mel, speaker
+            mel = mel[start:start + self.segment_len]
+        # Stay in fp16 (as stored on disk), the batch is upcast once it is on the device.
+        mel = torch.from_numpy(np.array(mel))
+        return mel, int(self.labels[index])
 
     def get_speaker_number(self):
         return self.speaker_num
@@ -111,11 +164,15 @@ Dataloader
 def collate_batch(batch):
     # Process features within a batch.
     """Collate a batch of data."""
-    mel, speaker = zip(*batch)
-    # Because we train the model batch by batch, we need to pad the features in the same batch to make their lengths the same.
-    mel = pad_sequence(mel, batch_first=True, padding_value=-20)  # pad log 10^(-20) which is very small value.
-    # mel: (batch size, length, 40)
-    return mel, torch.FloatTensor(speaker).long()
+    mels, speaker = zip(*batch)
+    # Pad (or crop) every batch to the same "SEGMENT_LEN" frames, so the model always sees a single input shape.
+    mel = torch.full((len(mels), SEGMENT_LEN, mels[0].shape[-1]), -20., dtype=mels[0].dtype)  # pad log 10^(-20) which is very small value.
+    for i, m in enumerate(mels):
+        m = m[:SEGMENT_LEN]
+        mel[i, :len(m)] = m
+    # mel: (batch size, SEGMENT_LEN, 40)
+    # Turn the speaker ids into long for computing loss later.
+    return mel, torch.tensor(speaker, dtype=torch.long)
 
 
 def get_dataloader(data_dir, batch_size, n_workers):
@@ -134,6 +191,9 @@ def get_dataloader(data_dir, batch_size, n_workers):
         drop_last=True,
         num_workers=n_workers,
         pin_memory=True,
+        # Keep the workers alive across epochs and let them prefetch ahead of the GPU.
+        persistent_workers=n_workers > 0,
+        prefetch_factor=4 if n_workers > 0 else None,
         collate_fn=collate_batch,
     )
     valid_loader = DataLoader(
@@ -142,12 +202,54 @@ def get_dataloader(data_dir, batch_size, n_workers):
         num_workers=n_workers,
         drop_last=True,
         pin_memory=True,
+        # Keep the workers alive across epochs and let them prefetch ahead of the GPU.
+        persistent_workers=n_workers > 0,
+        prefetch_factor=4 if n_workers > 0 else None,
         collate_fn=collate_batch,
     )
 
     return train_loader, valid_loader, speaker_num
 
 
+class CUDAPrefetcher:
+    """Endlessly iterate a dataloader, copying the next batch to the GPU on a side stream."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.iterator = iter(loader)
+        self.stream = torch.cuda.Stream() if device.type == "cuda" else None
+        self._preload()
+
+    def _preload(self):
+        try:
+            mels, labels = next(self.iterator)
+        except StopIteration:
+            # Start a new epoch.
+            self.iterator = iter(self.loader)
+            mels, labels = next(self.iterator)
+
+        if self.stream is None:
+            self.next_mels, self.next_labels = mels, labels
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_mels = mels.to(self.device, non_blocking=True)
+            self.next_labels = labels.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stream is not None:
+            # Wait for the copy, and keep the tensors alive until the compute stream is done with them.
+            torch.cuda.current_stream().wait_stream(self.stream)
+            self.next_mels.record_stream(torch.cuda.current_stream())
+            self.next_labels.record_stream(torch.cuda.current_stream())
+        batch = self.next_mels, self.next_labels
+        self._preload()
+        return batch
+
+
 '''
 Model
 TransformerEncoderLayer:
@@ -176,18 +278,21 @@ class Classifier(nn.Module):
         # TODO:
         #   Change Transformer to Conformer.
         #   https://arxiv.org/abs/2005.08100
+        # batch_first takes (batch size, length, d_model) directly, so no permutes are needed around the layer.
+        # norm_first applies the layer norm before attention and feedforward (pre-LN) instead of after them
+        # (post-LN). This changes the architecture: it trains differently, and post-LN weights of older
+        # checkpoints do not mean the same thing in it.
         self.encoder_layer = nn.TransformerEncoderLayer(
-            d_model=d_model, nhead=2, dim_feedforward=256
+            d_model=d_model, nhead=2, dim_feedforward=256, batch_first=True, norm_first=True
         )
         # self.encoder = nn.TransformerEncoder(self.encoder_layer, num_layers=2)
 
         # Project the the dimension of features from d_model into speaker nums.
+        # A single hidden layer is enough for the pooled d_model vector, and halves the kernel launches of the head.
         self.pred_layer = nn.Sequential(
             nn.Linear(d_model, d_model * 2),
             nn.ReLU(),
-            nn.Linear(d_model * 2, d_model * 4),
-            nn.ReLU(),
-            nn.Linear(d_model * 4, n_spks),
+            nn.Linear(d_model * 2, n_spks),
         )
 
     def forward(self, mels):
@@ -199,12 +304,8 @@ class Classifier(nn.Module):
         """
         # out: (batch size, length, d_model)
         out = self.prenet(mels)
-        # out: (length, batch size, d_model)
-        out = out.permute(1, 0, 2)
-        # The encoder layer expect features in the shape of (length, batch size, d_model).
+        # The encoder layer expect features in the shape of (batch size, length, d_model).
         out = self.encoder_layer(out)
-        # out: (batch size, length, d_model)
-        out = out.transpose(0, 1)
         # mean pooling
         stats = out.mean(dim=1)
 
@@ -277,12 +378,14 @@ def model_fn(batch, model, criterion, device):
     """Forward a batch through the model."""
 
     mels, labels = batch
-    mels = mels.to(device)
-    labels = labels.to(device)
-
-    outs = model(mels)
+    # The batches come from pinned memory, so the copies can overlap with computation.
+    mels = mels.to(device, non_blocking=True).float()
+    labels = labels.to(device, non_blocking=True)
 
-    loss = criterion(outs, labels)
+    # Mixed precision: matmuls run in fp16 on the GPU, autocast is a no-op on the CPU.
+    with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == "cuda"):
+        outs = model(mels)
+        loss = criterion(outs, labels)
 
     # Get the speaker id with highest probability.
     preds = outs.argmax(1)
@@ -302,15 +405,16 @@ def valid(dataloader, model, criterion, device):
     """ Validate on validation set. """
 
     model.eval()
-    running_loss = 0.0
-    running_accuracy = 0.0
+    # Accumulate on the device, so there is no GPU synchronization per batch.
+    running_loss = torch.zeros((), device=device)
+    running_accuracy = torch.zeros((), device=device)
     # pbar = tqdm(total=len(dataloader.dataset), ncols=0, desc="Valid", unit=" uttr")
 
     for i, batch in enumerate(dataloader):
-        with torch.no_grad():
+        with torch.inference_mode():
             loss, accuracy = model_fn(batch, model, criterion, device)
-            running_loss += loss.item()
-            running_accuracy += accuracy.item()
+            running_loss += loss.detach()
+            running_accuracy += accuracy.detach()
 
         # pbar.update(dataloader.batch_size)
         # pbar.set_postfix(
@@ -321,7 +425,7 @@ def valid(dataloader, model, criterion, device):
     # pbar.close()
     model.train()
 
-    return running_loss / len(dataloader), running_accuracy / len(dataloader)
+    return running_loss.item() / len(dataloader), running_accuracy.item() / len(dataloader)
 
 
 '''
@@ -335,10 +439,10 @@ def parse_main_args():
         "data_dir": "./Dataset",
         "save_path": "model.ckpt",
         "batch_size": 1024,
-        "n_workers": 0,
+        "n_workers": min(8, os.cpu_count() or 1),
+        "log_steps": 10,
         "valid_steps": 100,
         "warmup_steps": 10,
-        "save_steps": 100,
         "total_steps": 100000,
     }
 
@@ -350,56 +454,85 @@ def main(
         save_path,
         batch_size,
         n_workers,
+        log_steps,
         valid_steps,
         warmup_steps,
         total_steps,
-        save_steps,
 ):
     """Main function."""
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"[Info]: Use {device} now!")
+    # Let fp32 matmuls run on the tensor cores (TF32) and let cuDNN pick the fastest algorithms.
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
 
     train_loader, valid_loader, speaker_num = get_dataloader(data_dir, batch_size, n_workers)
-    train_iterator = iter(train_loader)
+    train_iterator = CUDAPrefetcher(train_loader, device)
     print(f"[Info]: Finish loading data!", flush=True)
 
     model = Classifier(n_spks=speaker_num).to(device)
     criterion = nn.CrossEntropyLoss()
-    optimizer = AdamW(model.parameters(), lr=1e-3)
+    # Update all the parameters with a single fused CUDA kernel (PyTorch >= 2.0),
+    # or fall back to the multi-tensor implementation on older versions.
+    try:
+        optimizer = AdamW(model.parameters(), lr=1e-3, fused=device.type == "cuda")
+    except TypeError:
+        optimizer = AdamW(model.parameters(), lr=1e-3, foreach=True)
     scheduler = get_cosine_schedule_with_warmup(optimizer, warmup_steps, total_steps)
+    # Scale the loss to keep fp16 gradients from underflowing.
+    scaler = torch.amp.GradScaler("cuda", enabled=device.type == "cuda")
     print(f"[Info]: Finish creating model!", flush=True)
 
     if os.path.isfile(save_path):
+        print(f"{Bcolors.WARNING}[Warning]: Checkpoints saved before the encoder layer became pre-LN (norm_first) "
+              f"and the pred_layer became two layers are architecture-incompatible, and should be retrained "
+              f"rather than resumed.{Bcolors.ENDC}")
         print(f"{save_path} exists, do you want to load the last model? (y/n)")
         yn = input()
         if yn == "y" or yn == "Y":
             print("Loading last model")
-            model.load_state_dict(torch.load(save_path), strict=False)
+            state_dict = torch.load(save_path)
+            # Skip the weights whose shapes changed with the architecture (e.g. checkpoints saved with the older,
+            # larger pred_layer), instead of failing with a size mismatch.
+            model_state_dict = model.state_dict()
+            for key in list(state_dict.keys()):
+                if key in model_state_dict and state_dict[key].shape != model_state_dict[key].shape:
+                    print(f"{Bcolors.WARNING}[Warning]: Skip {key}, shape {tuple(state_dict[key].shape)} "
+                          f"does not match {tuple(model_state_dict[key].shape)}.{Bcolors.ENDC}")
+                    del state_dict[key]
+            model.load_state_dict(state_dict, strict=False)
+
+    # Fuse the pointwise ops of the model. Training segments are always "segment_len" frames long,
+    # so the compiled graph is specialized on a single shape.
+    # Keep "model" uncompiled, so the saved state dict has no "_orig_mod." prefix.
+    train_model = model
+    if device.type == "cuda" and hasattr(torch, "compile"):
+        train_model = torch.compile(model, mode="reduce-overhead")
 
     best_accuracy = -1.0
     best_loss = 100000000.0
+    # Training loss and accuracy are summed on the device and only synchronized every "log_steps" steps.
+    loss_sum = torch.zeros((), device=device)
+    accuracy_sum = torch.zeros((), device=device)
 
     # pbar = tqdm(total=valid_steps, ncols=0, desc="Train", unit=" step")
 
     try:
         for step in range(total_steps):
             # Get data
-            try:
-                batch = next(train_iterator)
-            except StopIteration:
-                train_iterator = iter(train_loader)
-                batch = next(train_iterator)
+            batch = next(train_iterator)
 
-            best_state_dict = None
-            loss, accuracy = model_fn(batch, model, criterion, device)
-            batch_loss = loss.item()
-            batch_accuracy = accuracy.item()
+            loss, accuracy = model_fn(batch, train_model, criterion, device)
+            loss_sum += loss.detach()
+            accuracy_sum += accuracy.detach()
 
             # Update model
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
             # Log
             # pbar.update()
@@ -409,13 +542,18 @@ def main(
             #     step=step + 1,
             # )
 
-            print(f"\r[ Train | {step + 1:03d}/{total_steps:03d} ] loss = {loss:.5f}, acc = {accuracy:.5f}", flush=True, end=' ')
+            if (step + 1) % log_steps == 0:
+                batch_loss = loss_sum.item() / log_steps
+                batch_accuracy = accuracy_sum.item() / log_steps
+                loss_sum.zero_()
+                accuracy_sum.zero_()
+                print(f"\r[ Train | {step + 1:03d}/{total_steps:03d} ] loss = {batch_loss:.5f}, acc = {batch_accuracy:.5f}", flush=True, end=' ')
 
             # Do validation
             if (step + 1) % valid_steps == 0:
                 # pbar.close()
 
-                valid_loss, valid_accuracy = valid(valid_loader, model, criterion, device)
+                valid_loss, valid_accuracy = valid(valid_loader, train_model, criterion, device)
                 print(f"\n[ Valid | {step + 1:03d}/{total_steps:03d} ] loss = {valid_loss:.5f}, acc = {valid_accuracy:.5f}")
 
                 # keep the best model
@@ -426,16 +564,14 @@ def main(
                 if best_loss > valid_loss:
                     best_loss = valid_loss
                     best_accuracy = valid_accuracy
-                    best_state_dict = model.state_dict()
+                    # Save the best model so far, right away: these are the weights that were just validated,
+                    # and no copy of them is kept in memory.
+                    torch.save(model.state_dict(), save_path)
+                    # pbar.write(f"Step {step + 1}, best model saved. (accuracy={best_accuracy:.4f})")
+                    print(f"Step {step + 1}, best model saved. (loss = {best_loss:.4f}, accuracy = {best_accuracy:.4f})")
 
                 # pbar = tqdm(total=valid_steps, ncols=0, desc="Train", unit=" step")
 
-            # Save the best model so far.
-            if (step + 1) % save_steps == 0 and best_state_dict is not None:
-                torch.save(best_state_dict, save_path)
-                # pbar.write(f"Step {step + 1}, best model saved. (accuracy={best_accuracy:.4f})")
-                print(f"Step {step + 1}, best model saved. (loss = {best_loss:.4f}, accuracy = {best_accuracy:.4f})")
-
             if (step + 1) % valid_steps == 0:
                 print("\n")
 
@@ -461,7 +597,8 @@ class InferenceDataset(Dataset):
         testdata_path = Path(data_dir) / "testdata.json"
         metadata = json.load(testdata_path.open())
         self.data_dir = data_dir
-        self.data = metadata["utterances"]
+        # Sort the utterances by length, so the ones of the same length are next to each other.
+        self.data = sorted(metadata["utterances"], key=lambda utterance: utterance["mel_len"])
 
     def __len__(self):
         return len(self.data)
@@ -473,6 +610,27 @@ class InferenceDataset(Dataset):
 
         return feat_path, mel
 
+    def get_batches(self, batch_size):
+        """
+        Group the indices of utterances with exactly the same length into batches.
+        The model has no padding mask, so padding would change the predictions.
+        Batches of long utterances are made smaller, so the attention memory (batch size * length^2) stays
+        within that of "batch_size" utterances of "SEGMENT_LEN" frames.
+        """
+        batches = []
+        batch = []
+        for index, utterance in enumerate(self.data):
+            mel_len = utterance["mel_len"]
+            max_batch_size = max(1, batch_size * SEGMENT_LEN ** 2 // mel_len ** 2)
+            if batch and (self.data[batch[0]]["mel_len"] != mel_len or len(batch) >= max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+
+        return batches
+
 
 def inference_collate_batch(batch):
     """Collate a batch of data."""
@@ -505,6 +663,10 @@ def main(
     """Main function."""
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"[Info]: Use {device} now!")
+    # Let fp32 matmuls run on the tensor cores (TF32) and let cuDNN pick the fastest algorithms.
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
 
     mapping_path = Path(data_dir) / "mapping.json"
     mapping = json.load(mapping_path.open())
@@ -512,10 +674,9 @@ def main(
     dataset = InferenceDataset(data_dir)
     dataloader = DataLoader(
         dataset,
-        batch_size=1,
-        shuffle=False,
-        drop_last=False,
+        batch_sampler=dataset.get_batches(batch_size=64),
         num_workers=0,
+        pin_memory=True,
         collate_fn=inference_collate_batch,
     )
     print(f"[Info]: Finish loading data!", flush=True)
@@ -524,12 +685,17 @@ def main(
     model = Classifier(n_spks=speaker_num).to(device)
     model.load_state_dict(torch.load(model_path))
     model.eval()
+    # Trace the model into TorchScript and freeze it, which folds the parameters in as constants
+    # and fuses the pointwise ops. Only done for inference.
+    with torch.no_grad():
+        example = torch.randn(1, SEGMENT_LEN, 40, device=device)
+        model = torch.jit.freeze(torch.jit.trace(model, example))
     print(f"[Info]: Finish creating model!", flush=True)
 
     results = [["Id", "Category"]]
     for feat_paths, mels in tqdm(dataloader):
-        with torch.no_grad():
-            mels = mels.to(device)
+        with torch.inference_mode():
+            mels = mels.to(device, non_blocking=True)
             outs = model(mels)
             preds = outs.argmax(1).cpu().numpy()
             for feat_path, pred in zip(feat_paths, preds):